@@ -61,39 +61,207 @@ Ver. 1.1.5 /halpe, Jan 2017
 Created by: Martin Hvidberg <mahvi@gst.dk> (first versions)
             Hanne L. Petersen <halpe@sdfe.dk> (recent versions)
 """
+import os
 import sys
+import json
+import time
+import pickle
+import hashlib
 import logging
+import tempfile
+import functools
+import collections
 import arcpy
 import re
 import socket
+import threading
 from datetime import datetime as dt, timedelta
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport (pip install futures)
+    ThreadPoolExecutor = None
+
+try:
+    string_types = (str, basestring)  # Python 2
+except NameError:
+    string_types = (str,)  # Python 3
+
+
+class _SerialExecutor(object):
+    """Stand-in for ThreadPoolExecutor, running the calls one at a time, when concurrent.futures is missing."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def map(self, func, *iterables):
+        return [func(*args) for args in zip(*iterables)]
+
+    def shutdown(self, wait=True):
+        pass
+
+
+if ThreadPoolExecutor is None:
+    ThreadPoolExecutor = _SerialExecutor
 
 individual_analyze = False
+# Skip the second analyze of a data owner whose datasets are unchanged, and who has no edit versions,
+# if it was last analyzed less than this many days ago (0 means always analyze).
+# Note that edits made directly on SDE.DEFAULT are not detected, so only use this for rarely edited data.
+# When set, the dataset lists are always fetched from the database, bypassing the cache.
+max_skip_days = 0
+
+# Dataset lists are cached here between runs; set the environment variable SDE_CRA_CACHE=0 to bypass.
+# Datasets created in the database don't touch the connection file, so a cached list can miss them:
+# it is reused for at most dataset_cache_hours, which keeps it within one day's runs, not across weekly runs.
+cache_dir = os.path.join(tempfile.gettempdir(), "sde_cra_cache")
+dataset_cache_hours = 12
+analyze_time_format = "%Y-%m-%dT%H:%M:%S"
+
+
+def _cache_enabled():
+    """Return False if the cache is bypassed with SDE_CRA_CACHE=0."""
+    return os.environ.get("SDE_CRA_CACHE") != "0"
+
+
+def _cache_path(workspace, suffix=".json"):
+    """Return the path of the cache file for the workspace."""
+    workspace = os.path.abspath(workspace)  # the same key for relative paths from different working directories
+    key = hashlib.sha1(workspace if isinstance(workspace, bytes) else workspace.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + suffix)
+
+
+def _write_cache(path, data):
+    """Write data as JSON to the cache file path."""
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def invalidate_dataset_cache(workspace):
+    """Remove the cached dataset list for the workspace, if any."""
+    try:
+        os.remove(_cache_path(workspace))
+    except OSError:
+        pass
+
+
+def _datasets_hash(data_lst):
+    """Return a hash of the dataset list, independent of the order of the list."""
+    names = [name if isinstance(name, bytes) else name.encode('utf-8') for name in data_lst]
+    return hashlib.sha1(b"\n".join(sorted(names))).hexdigest()
+
+
+def analyze_unchanged(workspace, data_lst, lst_versions):
+    """
+    Return True if the data owner analyze can be skipped for the workspace.
+
+    That is if max_skip_days is set, there are no versions but SDE.DEFAULT, and the dataset list
+    is the same as at the last analyze recorded by record_analyze(), less than max_skip_days ago.
+    """
+    if max_skip_days <= 0 or not _cache_enabled() or len(lst_versions) > 1:
+        return False
+    try:
+        with open(_cache_path(workspace, ".analyze.json")) as f:
+            last = json.load(f)
+        last_time = dt.strptime(last['timestamp'], analyze_time_format)
+        return last['hash'] == _datasets_hash(data_lst) and dt.now() - last_time < timedelta(days=max_skip_days)
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+
+
+def record_analyze(workspace, data_lst):
+    """Record that the datasets in data_lst were analyzed now, for analyze_unchanged()."""
+    if not _cache_enabled():
+        return
+    try:
+        _write_cache(_cache_path(workspace, ".analyze.json"),
+                     {'hash': _datasets_hash(data_lst), 'timestamp': dt.now().strftime(analyze_time_format)})
+    except (IOError, OSError) as e:
+        logging.warning("Could not record analyze of %s: %r", workspace, e)
+
+
+def cached_by_mtime(func):
+    """
+    Cache the result of func(workspace) on disk, until the connection file is modified.
+
+    A cached result is not reused after dataset_cache_hours, since changes in the database itself
+    (e.g. new tables) don't modify the connection file.
+    The cache is bypassed if the environment variable SDE_CRA_CACHE is set to 0.
+    The uncached function is available as the attribute uncached.
+    """
+    @functools.wraps(func)
+    def wrapper(workspace):
+        if not _cache_enabled():
+            return func(workspace)
+        try:
+            mtime = os.path.getmtime(workspace)
+        except OSError:
+            # e.g. ArcMap's virtual "Database Connections\..." paths, which aren't files on disk
+            logging.debug("Not caching dataset list for %s, not a file", workspace)
+            return func(workspace)
+        path = _cache_path(workspace)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['mtime'] == mtime and time.time() - cached['created'] < dataset_cache_hours * 3600:
+                logging.debug("Using cached dataset list for %s", workspace)
+                return cached['data_lst']
+        except (IOError, OSError, ValueError, KeyError):
+            pass  # no usable cache, so fetch the list from the database
+        data_lst = func(workspace)
+        try:
+            _write_cache(path, {'mtime': mtime, 'created': time.time(), 'data_lst': data_lst})
+        except (IOError, OSError) as e:
+            logging.warning("Could not cache dataset list for %s: %r", workspace, e)
+        return data_lst
+    wrapper.uncached = func
+    return wrapper
+
+
+def clear_workspace_cache(workspace):
+    """Release arcpy's cached connection to the workspace, so connections don't pile up on the server."""
+    try:
+        arcpy.ClearWorkspaceCache_management(workspace)
+    except Exception as e:  # never hide the error of the phase this is cleaning up after
+        logging.warning("Could not clear workspace cache for %s: %r", workspace, e)
 
 
+@cached_by_mtime
 def list_datasets(workspace):
     """
     Get a list of datasets owned by the workspace user.
 
+    The list is cached for a while, see cached_by_mtime().
     This assumes you are using database authentication.
     OS authentication connection files do not have a 'user' property.
     """
-    arcpy.env.workspace = workspace
-    if arcpy.Describe(arcpy.env.workspace).dataType != "Workspace":
+    desc = arcpy.Describe(workspace)
+    if desc.dataType != "Workspace":
         logging.error("Workspace not recognised - something is wrong. Please check your TNS settings.")
     # Get the user name for the workspace.
-    user_name = arcpy.Describe(arcpy.env.workspace).connectionProperties.user
-    all_users = user_name + '.*'  # For non-Oracle try: '*.' + user_name + '.*'
+    user_prefix = desc.connectionProperties.user.upper() + '.'  # For non-Oracle try matching '.' + user_name + '.'
 
-    # Get a list of all the datasets the user has access to.
-    # First, get all the stand alone tables, feature classes and rasters.
-    data_lst = arcpy.ListTables(all_users) + arcpy.ListFeatureClasses(all_users) + arcpy.ListRasters(all_users)
+    def owned(name):
+        return name.upper().startswith(user_prefix)
 
-    # Next, for feature datasets get all of the feature classes
-    # from the list and add them to the master list.
-    for dataset in arcpy.ListDatasets(all_users):
-        data_lst += arcpy.ListFeatureClasses(feature_dataset=dataset)
+    # Get a list of all the datasets the user has access to, in a single traversal of the workspace:
+    # the stand alone tables, feature classes and rasters, and the feature classes in the user's feature datasets.
+    data_lst = []
+    for dirpath, dirnames, filenames in arcpy.da.Walk(workspace, datatype=["Table", "FeatureClass", "RasterDataset"]):
+        dirnames[:] = [d for d in dirnames if owned(d)]  # only descend into the user's own feature datasets
+        data_lst += [os.path.basename(f) for f in filenames if owned(f)]
 
+    clear_workspace_cache(workspace)
     return data_lst
 
 
@@ -117,239 +285,347 @@ def compress(workspace):
     return 0
 
 
-def rebuild_indexes(workspace, data_lst):
-    """Run arcpy.RebuildIndexes_management on the datasets in the list."""
+def rebuild_indexes(workspace, data_lst, success_level=logging.INFO):
+    """Run arcpy.RebuildIndexes_management on the datasets in the list, logging success at success_level."""
     # Note: to use the "SYSTEM" option the user must be an administrator.
     # To access the actual data sets, we need the data owner.
     # So we need to run once for each.
     try:
-        logging.debug("rebuild: " + workspace + ", " + str(data_lst))
+        logging.debug("rebuild: %s, %s", workspace, data_lst)
         if data_lst == '' or data_lst == []:  # workspace is sde
             arcpy.RebuildIndexes_management(workspace, "SYSTEM", "", "ALL")
         else:  # workspace is data owner
             arcpy.RebuildIndexes_management(workspace, "NO_SYSTEM", data_lst, "ALL")
-        logging.info("      > Rebuild successful: " + str(data_lst))
+        logging.log(success_level, "      > Rebuild successful: %s", data_lst)
         return 0
     except arcpy.ExecuteError as x:
-        logging.error("      > ExecuteError is: "+repr(x))
+        logging.error("      > ExecuteError is: %r", x)
+        invalidate_dataset_cache(workspace)  # the list may be outdated, e.g. a dataset was deleted
         return 1
-    except BaseException as e:
-        logging.error("      > Non-arcpy problem with: " + str(data_lst) + repr(e))
-        logging.error(arcpy.GetMessages())
+    except Exception as e:  # but let KeyboardInterrupt and SystemExit stop the run
+        # (not arcpy.GetMessages(), which may belong to another tool when rebuilding in parallel)
+        logging.error("      > Non-arcpy problem with: %s%r", data_lst, e)
         return 1
 
 
+def rebuild_indexes_parallel(workspace, data_lst, workers=4):
+    """
+    Run rebuild_indexes() on each dataset in the list separately, with up to workers at a time.
+
+    A single locked dataset then only fails its own rebuild. Returns 1 if any of the rebuilds failed.
+    Only for data owners: the "SYSTEM" rebuild for sde touches shared catalog tables, so run that alone.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The individual successes are only logged at debug level, to keep the report short
+        results = list(executor.map(lambda fc: rebuild_indexes(workspace, [fc], logging.DEBUG), data_lst))
+    failed = [fc for fc, result in zip(data_lst, results) if result != 0]
+    if failed:
+        logging.error("      > Rebuild failed for %d of %d datasets in %s: %s",
+                      len(failed), len(data_lst), workspace, failed)
+        return 1
+    logging.info("      > Rebuild successful: %d datasets in %s", len(data_lst), workspace)
+    return 0
+
+
+_compiled_patterns = {}  # pattern -> compiled regular expression, for get_sde_id()
+
+
+def _compile(pattern):
+    """Return pattern compiled, reusing earlier compilations of the same pattern."""
+    try:
+        return _compiled_patterns[pattern]
+    except KeyError:
+        return _compiled_patterns.setdefault(pattern, re.compile(pattern))
+
+
 def get_sde_id(pattern, string, n=1):
-    """Extract an id from an sde string. Return the first part of string that matches pattern, or the whole string."""
-    m = re.search(pattern, string)
+    """
+    Extract an id from an sde string. Return the first part of string that matches pattern, or the whole string.
+
+    pattern can be a string or a compiled regular expression.
+    """
+    m = _compile(pattern).search(string)
     if m is not None:
         return m.group(n)
     return string
 
 
-def perform_maintenance(con_dba, con_geo, mode, sde_id_match_pattern):
+def format_duration(td):
+    """Format a timedelta as h:mm:ss.dddd."""
+    h, rem = divmod(int(td.total_seconds()), 3600)
+    m, s = divmod(rem, 60)
+    return "%d:%02d:%02d.%04d" % (h, m, s, td.microseconds // 100)
+
+
+def perform_maintenance(con_dba, con_geo, mode, sde_id_match_pattern, fuse_analyze=True):
     """
     Run maintenance routines specified by mode on the database connections.
 
-    con_GEO can be a string or an array of strings.
+    con_GEO can be a string or a sequence of strings.
 
     Valid modes can contain: cra, acra, aca, analyze, compress, rebuild, report, block, kick
+    mode can be a list of modes, or a string of comma separated modes.
+
+    With fuse_analyze (the default), acra skips the first analyze and runs like cra, since compress
+    doesn't change the datasets to analyze. Use fuse_analyze=False or mode aca to analyze before compress,
+    as is also done if individual_analyze is set.
     """
-    logging.info("Running perform_maintenance() on {}".format(socket.gethostname()))
+    logging.info("Running perform_maintenance() on %s", socket.gethostname())
     timer = ECtimes()
 
     t0 = dt.now()
     timer.time_stamp('Initialize', 'start', 'Start of Main()')
 
     logging.info(" * Auto Compress SDE - Main *")
-    logging.info("   Start time: {}".format(t0))
-    logging.info("   Connection DB admin: {}".format(con_dba))
-    logging.info("   Connection data owners: {}".format(con_geo))
-    logging.info("   Mode: {}".format(mode))
-
-    if isinstance(con_geo, basestring):
-        con_geo = [con_geo]
-
-    # List all versions for each connection
-    for con in con_geo:
-        lst_versions = arcpy.da.ListVersions(con)
-        if len(lst_versions) > 1:
-            logging.info("        Current versions (any but SDE.DEFAULT will prevent optimal compression): " +
-                         str([v.name for v in lst_versions]))
-        else:
-            logging.info("        No edit versions for {}.".format(con))
-
-    timer.time_stamp('Initialize', 'stop', 'Start of Main()')
-
-    # Block new connections to the database.
-    if 'block' in mode:
-        arcpy.AcceptConnections(con_dba, False)
-
-    if 'kick' in mode:
-        arcpy.DisconnectUser(con_dba, "ALL")
-
-    timer.time_stamp('main', 'start', '')  # Start main timer
+    logging.info("   Start time: %s", t0)
+    logging.info("   Connection DB admin: %s", con_dba)
+    logging.info("   Connection data owners: %s", con_geo)
+    logging.info("   Mode: %s", mode)
 
-    # Build a list of datasets owned by each data owner to the rebuild indexes and analyze datasets tools.
-    # SDE only owns COMPRESS_LOG
-    if mode != ['report']:
-        logging.info("   1. Get List Of Data Sets")
-        timer.time_stamp('list_data', 'start', '')
-        dict_conn2versions = {}
-        for con in con_geo:
-            dict_conn2versions[con] = list_datasets(con)
-        timer.time_stamp('list_data', 'stop', '')
-
-    # First Analyze
-    # (this is supposed to improve performance of Compress - but it can take so long it doesn't seem worthwhile)
-    if 'acra' in mode or 'aca' in mode:
-        logging.info("   1b. Analyze")
-        for con in con_geo:
-            logging.info("      " + con)
-            if len(dict_conn2versions[con]) > 0:
-                sde_id = get_sde_id(sde_id_match_pattern, con)
-                timer.time_stamp('analyze1_'+sde_id, 'start', '')
-                if individual_analyze:
-                    for fc in dict_conn2versions[con]:
-                        start = dt.now()
-                        analyze_data_owner(con, fc)
-                        logging.debug("Duration of {} in {}: {}".format(fc, con, str(dt.now() - start)[:-2]))
-                else:
-                    start = dt.now()
-                    analyze_data_owner(con, dict_conn2versions[con])
-                    logging.error("Duration of all fcs in {}: {}".format(con, str(dt.now() - start)[:-2]))
-                timer.time_stamp('analyze1_'+sde_id, 'stop', '')
-            else:
-                logging.info("Skipping empty data: "+con)
-        timer.time_stamp('analyze1_sde', 'start', '')
-        analyze_sde(con_dba)
-        timer.time_stamp('analyze1_sde', 'stop', '')
-
-    # Do the actual Compress
-    if 'cra' in mode or 'acra' in mode or 'aca' in mode or 'compress' in mode:
-        logging.info("   2. Compress")
-        timer.time_stamp('compress', 'start', '')
-        compress(con_dba)
-        timer.time_stamp('compress', 'stop', '')
-
-    # Do the Rebuild Indexes
-    if 'cra' in mode or 'acra' in mode or 'rebuild' in mode:
-        logging.info("   3. Rebuild Indexes")
+    if isinstance(con_geo, string_types):
+        con_geo = (con_geo,)
+    else:
+        con_geo = tuple(con_geo)
+
+    # Work out which phases to run
+    if isinstance(mode, string_types):
+        mode = mode.replace(',', ' ').split()
+    mode_set = frozenset(mode)
+    do_block = 'block' in mode_set
+    do_kick = 'kick' in mode_set
+    do_analyze1 = 'aca' in mode_set
+    if 'acra' in mode_set and not do_analyze1:
+        if fuse_analyze and not individual_analyze:
+            logging.info("   Mode acra: skipping the first analyze, "
+                         "the analyze after compress covers the same datasets")
+        else:
+            do_analyze1 = True
+    do_compress = bool(mode_set & {'cra', 'acra', 'aca', 'compress'})
+    do_rebuild = bool(mode_set & {'cra', 'acra', 'rebuild'})
+    do_analyze2 = bool(mode_set & {'cra', 'acra', 'aca', 'analyze'})
+    do_report = 'report' in mode_set
+
+    # Extract the id of each connection once, and build its timer groups
+    id_pattern = re.compile(sde_id_match_pattern)
+    sde_ids = {con: get_sde_id(id_pattern, con) for con in con_geo}
+    timer_keys = {con: {'a1': 'analyze1_' + sde_ids[con],
+                        'a2': 'analyze2_' + sde_ids[con],
+                        'r': 'rebuild_index_' + sde_ids[con]} for con in con_geo}
+
+    # Each data owner connection is independent, so the per-connection work is run concurrently,
+    # leaving the database server to do the work in parallel. Compress and the sde steps run alone.
+    # (Without concurrent.futures on Python 2, the connections are handled one at a time.)
+    with ThreadPoolExecutor(max_workers=max(1, len(con_geo))) as executor:
+
+        # List all versions for each connection, and keep them for the later phases
+        versions_by_con = dict(zip(con_geo, executor.map(arcpy.da.ListVersions, con_geo)))
         for con in con_geo:
-            if len(dict_conn2versions[con]) > 0:
-                sde_id = get_sde_id(sde_id_match_pattern, con)
-                timer.time_stamp('rebuild_index_'+sde_id, 'start', '')
-                logging.info("   Start time rebuild indexes: " + str(dt.now()))
-                rebuild_indexes(con, dict_conn2versions[con])
-                timer.time_stamp('rebuild_index_'+sde_id, 'stop', '')
+            lst_versions = versions_by_con[con]
+            if len(lst_versions) > 1:
+                logging.info("        Current versions (any but SDE.DEFAULT will prevent optimal compression): %s",
+                             [v.name for v in lst_versions])
             else:
-                logging.info("Skipping empty data: " + con)
-        timer.time_stamp('rebuild_index_sde', 'start', '')
-        rebuild_indexes(con_dba, "")
-        timer.time_stamp('rebuild_index_sde', 'stop', '')
-
-    # Second Analyze
-    # Running Analyze AFTER Compress is the important thing
-    if 'cra' in mode or 'acra' in mode or 'aca' in mode or 'analyze' in mode:
-        logging.info("   4. Analyze")
-        for con in con_geo:
-            if len(dict_conn2versions[con]) > 0:
-                sde_id = get_sde_id(sde_id_match_pattern, con)
-                timer.time_stamp('analyze2_'+sde_id, 'start', '')
-                logging.info("   Start time analyze: " + str(dt.now()))
-                analyze_data_owner(con, dict_conn2versions[con])
-                timer.time_stamp('analyze2_'+sde_id, 'stop', '')
-        timer.time_stamp('analyze2_sde', 'start', '')
-        analyze_sde(con_dba)
-        timer.time_stamp('analyze2_sde', 'stop', '')
-
-    timer.time_stamp('main', 'stop', '')  # Stop main timer
+                logging.info("        No edit versions for %s.", con)
+
+        timer.time_stamp('Initialize', 'stop', 'Start of Main()')
+
+        # Block new connections to the database.
+        if do_block:
+            arcpy.AcceptConnections(con_dba, False)
+
+        if do_kick:
+            arcpy.DisconnectUser(con_dba, "ALL")
+
+        timer.time_stamp('main', 'start', '')  # Start main timer
+
+        # Build a list of datasets owned by each data owner to the rebuild indexes and analyze datasets tools.
+        # SDE only owns COMPRESS_LOG
+        if do_analyze1 or do_rebuild or do_analyze2:
+            logging.info("   1. Get List Of Data Sets")
+            timer.time_stamp('list_data', 'start', '')
+            # A cached list would make the datasets look unchanged to analyze_unchanged()
+            lister = list_datasets.uncached if max_skip_days > 0 else list_datasets
+            dict_conn2versions = dict(zip(con_geo, executor.map(lister, con_geo)))
+            timer.time_stamp('list_data', 'stop', '')
+
+        # First Analyze
+        # (this is supposed to improve performance of Compress - but it can take so long it doesn't seem worthwhile)
+        if do_analyze1:
+            logging.info("   1b. Analyze")
+
+            def analyze1(con):
+                try:
+                    logging.info("      %s", con)
+                    if len(dict_conn2versions[con]) > 0:
+                        timer.time_stamp(timer_keys[con]['a1'], 'start', '')
+                        if individual_analyze:
+                            for fc in dict_conn2versions[con]:
+                                start = dt.now()
+                                analyze_data_owner(con, fc)
+                                logging.debug("Duration of %s in %s: %s", fc, con, format_duration(dt.now() - start))
+                        else:
+                            start = dt.now()
+                            analyze_data_owner(con, dict_conn2versions[con])
+                            logging.error("Duration of all fcs in %s: %s", con, format_duration(dt.now() - start))
+                        timer.time_stamp(timer_keys[con]['a1'], 'stop', '')
+                    else:
+                        logging.info("Skipping empty data: %s", con)
+                finally:
+                    clear_workspace_cache(con)
+            list(executor.map(analyze1, con_geo))
+            timer.time_stamp('analyze1_sde', 'start', '')
+            analyze_sde(con_dba)
+            timer.time_stamp('analyze1_sde', 'stop', '')
+
+        # Do the actual Compress
+        if do_compress:
+            logging.info("   2. Compress")
+            timer.time_stamp('compress', 'start', '')
+            compress(con_dba)
+            timer.time_stamp('compress', 'stop', '')
+
+        # Do the Rebuild Indexes
+        if do_rebuild:
+            logging.info("   3. Rebuild Indexes")
+
+            def rebuild(con):
+                try:
+                    if len(dict_conn2versions[con]) > 0:
+                        timer.time_stamp(timer_keys[con]['r'], 'start', '')
+                        logging.info("   Start time rebuild indexes: %s", dt.now())
+                        rebuild_indexes_parallel(con, dict_conn2versions[con])
+                        timer.time_stamp(timer_keys[con]['r'], 'stop', '')
+                    else:
+                        logging.info("Skipping empty data: %s", con)
+                finally:
+                    clear_workspace_cache(con)
+            list(executor.map(rebuild, con_geo))
+            timer.time_stamp('rebuild_index_sde', 'start', '')
+            rebuild_indexes(con_dba, "")
+            timer.time_stamp('rebuild_index_sde', 'stop', '')
+
+        # Second Analyze
+        # Running Analyze AFTER Compress is the important thing
+        if do_analyze2:
+            logging.info("   4. Analyze")
+
+            def analyze2(con):
+                try:
+                    if len(dict_conn2versions[con]) > 0:
+                        if analyze_unchanged(con, dict_conn2versions[con], versions_by_con[con]):
+                            logging.info("Skipping analyze2 for %s, unchanged since the last analyze", con)
+                            return
+                        timer.time_stamp(timer_keys[con]['a2'], 'start', '')
+                        logging.info("   Start time analyze: %s", dt.now())
+                        analyze_data_owner(con, dict_conn2versions[con])
+                        record_analyze(con, dict_conn2versions[con])
+                        timer.time_stamp(timer_keys[con]['a2'], 'stop', '')
+                finally:
+                    clear_workspace_cache(con)
+            list(executor.map(analyze2, con_geo))
+            timer.time_stamp('analyze2_sde', 'start', '')
+            analyze_sde(con_dba)
+            timer.time_stamp('analyze2_sde', 'stop', '')
+
+        timer.time_stamp('main', 'stop', '')  # Stop main timer
 
     # Allow the database to begin accepting connections again
-    if 'block' in mode:
+    if do_block:
         # Input connection must be administrator
         arcpy.AcceptConnections(con_dba, True)
 
     # Compile and log the profiling report
-    if 'report' in mode:
+    if do_report:
         logging.info(" * Compile a report")
         time_profile_report = timer.time_report()
-        logging.info("Time profile report:" + time_profile_report)
+        logging.info("Time profile report:%s", time_profile_report)
+        # Keep the timings, so reports across runs can be compared later with ECtimes.load()
+        timer_file = os.path.join(tempfile.gettempdir(), 'sde_cra_{}_{}.pkl'.format(
+            socket.gethostname(), t0.strftime('%Y%m%d')))
+        try:
+            timer.save(timer_file)
+            logging.info("Timings saved to %s", timer_file)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logging.warning("Could not save timings to %s: %r", timer_file, e)
 
     # All Done - Cleaning up
     tz = dt.now()
     duration = tz - t0
-    logging.info("End time: " + str(tz))
-    logging.info("Python script duration (h:mm:ss.dddd): " + str(duration)[:-2])
+    logging.info("End time: %s", tz)
+    logging.info("Python script duration (h:mm:ss.dddd): %s", format_duration(duration))
 
 
-class ECtimes:
+class ECtimes(object):
     """
     Module to facilitate timing of individual program sections and reporting.
 
     Created by: mahvi@gst.dk
     Class wrapping added by halpe@sdfe.dk
     """
-    lst_time = list()  # a list object to hold timing events
+    __slots__ = ('groups', '_lock')
 
     def __init__(self):
         """Clear all records and start anew."""
-        self.lst_time = list()
+        self.groups = collections.defaultdict(list)  # group -> list of (time, stst) timing events
+        self._lock = threading.Lock()  # time_stamp() may be called from several threads
 
-    def time_stamp(self, group, stst, text):
+    def time_stamp(self, group, stst, text=''):
         """
-        Create a timestamp in lst_time.
+        Create a timestamp in groups.
 
         group <text> : Time spend is accumulated by group
         stst <text> : ['start'|'stop']
-        text <text> : user defined text/comment
+        text <text> : user defined text/comment (not recorded)
         """
         if stst not in ['start', 'stop']:
             stst = 'stst'
-        self.lst_time.append([group, dt.now(), stst, text])
+        with self._lock:
+            self.groups[group].append((dt.now(), stst))
         return 0
 
     def time_report(self):
-        """Analyse timestamps in lst_time, and generate a report."""
-        dic_groups = dict()
+        """Analyse timestamps in groups, and generate a report."""
         dic_report = dict()
-        str_report = ""
-        for stamp in self.lst_time:
-            if stamp[0] not in dic_groups.keys():
-                dic_groups[stamp[0]] = list()
-            dic_groups[stamp[0]].append(stamp[1:])
-        for group in dic_groups.keys():
-            series = dic_groups[group]
-            deltatime = timedelta()
+        for group, series in self.groups.items():
             if len(series) % 2 == 1:  # Check if length is even
                 continue
-            series.sort()
-            for i in range(len(series))[::2]:
-                if series[i][1] == 'start':
-                    if series[i+1][1] == 'stop':
-                        dur_s = series[i+1][0] - series[i][0]  # note this is a timedelta object, not just a number
-                        deltatime += dur_s
-                    else:
-                        # TODO: error handling
-                        pass
-                else:
-                    # TODO: error handling
-                    pass
+            # The series is already in time order, since stamps are appended as they are taken
+            pairs = [(start, stop) for start, stop in zip(series[0::2], series[1::2])
+                     if start[1] == 'start' and stop[1] == 'stop']
+            if len(pairs) < len(series) // 2:
+                logging.warning("Timer group %s: ignoring %d stamps that aren't start/stop pairs",
+                                group, len(series) - 2 * len(pairs))
+            deltatime = sum((stop[0] - start[0] for start, stop in pairs), timedelta())
             dic_report[group] = "group: {} = {} seconds".format(group, deltatime.total_seconds())
-        rep_keys = dic_report.keys()
-        rep_keys.sort()
-        for key_r in rep_keys:
-            str_report += "\n" + dic_report[key_r]
-        return str_report
+        if not dic_report:
+            return ""
+        return "\n" + "\n".join(dic_report[key_r] for key_r in sorted(dic_report))
+
+    def save(self, path):
+        """Save the timestamps in groups to a pickle file."""
+        with open(path, 'wb') as f:
+            pickle.dump(self.groups, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return 0
+
+    @classmethod
+    def load(cls, path):
+        """Create an ECtimes with the timestamps from a file written by save()."""
+        timer = cls()
+        with open(path, 'rb') as f:
+            timer.groups.update(pickle.load(f))
+        return timer
 # End class ECtimes
 
 
 def main():
     """Perform maintenance on command line inputs."""
-    if len(sys.argv) == 5:
-        perform_maintenance(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    args = [a for a in sys.argv[1:] if a != '--no-fuse-analyze']
+    fuse_analyze = len(args) == len(sys.argv) - 1
+    if len(args) == 4:
+        perform_maintenance(args[0], args[1], args[2], args[3], fuse_analyze)
     else:
-        print("Usage: " + __file__ + " CONN_SDE CONN_DO MODE ID_REGEX")
+        print("Usage: " + __file__ + " CONN_SDE CONN_DO MODE ID_REGEX [--no-fuse-analyze]")
+        print("  --no-fuse-analyze: run the first analyze in mode acra, see perform_maintenance()")
 
 
 if __name__ == "__main__":
@@ -43,7 +43,7 @@ def run():
 
     # Options:
     # - cra: Compress-RebuildIndexes-Analyze
-    # - acra: Analyze-Compress-RebuildIndexes-Analyze
+    # - acra: Analyze-Compress-RebuildIndexes-Analyze (runs as cra, unless called with fuse_analyze=False)
     # - aca: Analyze-Compress-Analyze
     # - report: log timer report
     # - block: block for connections to the database while running the script
@@ -89,7 +89,7 @@ def analyze_by_fc(conn, first, last):
     tz = dt.now()
     duration = tz - t0
     logging.info("End time: {}".format(tz))
-    logging.info("Python script duration (h:mm:ss.dddd): " + str(duration)[:-2])
+    logging.info("Python script duration (h:mm:ss.dddd): " + SDE_CRA.format_duration(duration))
 
 
 def rebuild_by_fc(conn, first, last):
@@ -114,7 +114,7 @@ def rebuild_by_fc(conn, first, last):
     tz = dt.now()
     duration = tz - t0
     logging.info("End time: " + str(tz))
-    logging.info("Python script duration (h:mm:ss.dddd): " + str(duration)[:-2])
+    logging.info("Python script duration (h:mm:ss.dddd): " + SDE_CRA.format_duration(duration))
 
 
 if __name__ == "__main__":